@@ -1,12 +1,14 @@
 import streamlit as st
-import requests
 import json
 import re
 import io
-from docx import Document
-from docx.shared import Inches
-import fitz  # PyMuPDF
+import os
+import hashlib
+import tempfile
+import time
+from collections import Counter
 from datetime import datetime
+from xml.sax.saxutils import escape
 
 st.set_page_config(page_title="GLR Pipeline", layout="wide")
 
@@ -23,85 +25,278 @@ MODEL = st.sidebar.selectbox("Select LLM Model", [
     "mistralai/mistral-7b-instruct:free"
 ])
 
-def extract_text_from_pdf(pdf_file):
-    """Extract text from PDF file."""
-    text = ""
+@st.cache_data(show_spinner=False)
+def extract_text_from_pdf(pdf_bytes):
+    """Extract text from PDF bytes without page boilerplate, cached by content across reruns."""
+    import fitz  # PyMuPDF
+    
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    # Reading order does not matter to the LLM, so skip MuPDF's block sort
+    parts = [page.get_text("text", sort=False) for page in doc]
+    doc.close()
+    return strip_page_boilerplate(parts)
+
+def strip_page_boilerplate(pages):
+    """Drop header/footer lines found on most pages of one report and collapse blank runs.
+    
+    Boilerplate keeps its first occurrence; other repeated lines (wrapped captions) are kept.
+    A repeated label line (ending in ":") is also kept when the line after it is kept,
+    so labels such as "Taken By:" stay attached to a new value.
+    """
+    page_lines = [page.splitlines() for page in pages]
+    page_counts = Counter()
+    for lines in page_lines:
+        page_counts.update({line.strip() for line in lines if line.strip()})
+    boilerplate = {key for key, count in page_counts.items() if count > 1 and count * 2 > len(pages)}
+    
+    lines = [line for page in page_lines for line in page]
+    seen = set()
+    keep = []
+    for line in lines:
+        key = line.strip()
+        keep.append(key not in boilerplate or key not in seen)
+        seen.add(key)
+    
+    # Walk backwards so each label can see whether its value line survived
+    next_kept = False
+    for i in range(len(lines) - 1, -1, -1):
+        key = lines[i].strip()
+        if not key:
+            continue
+        if not keep[i] and key.endswith(":") and next_kept:
+            keep[i] = True
+        next_kept = keep[i]
+    
+    deduped = []
+    previous_blank = False
+    for line, kept in zip(lines, keep):
+        if not kept:
+            continue
+        if not line.strip():
+            if not previous_blank:
+                deduped.append("")
+                previous_blank = True
+            continue
+        deduped.append(line)
+        previous_blank = False
+    return "\n".join(deduped)
+
+# Photo report input budget per LLM prompt
+PHOTO_TEXT_TOKEN_BUDGET = 3000
+
+@st.cache_resource
+def get_token_encoding():
+    """Tokenizer used to budget prompt input; approximate for non-OpenAI models."""
+    import tiktoken
+    
+    return tiktoken.encoding_for_model("gpt-4")
+
+# Rough characters-per-token ratio used when the tokenizer is unavailable
+CHARS_PER_TOKEN = 4
+
+def truncate_to_tokens(text, max_tokens):
+    """Truncate text to max_tokens, cutting back to a line boundary."""
     try:
-        pdf_bytes = pdf_file.read()
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        for page in doc:
-            text += page.get_text() + "\n"
-        doc.close()
-    except Exception as e:
-        st.error(f"Error extracting PDF: {e}")
-    return text
+        encoding = get_token_encoding()
+    except Exception:
+        # tiktoken downloads its BPE file on first use; without network, budget by characters instead
+        encoding = None
+    
+    if encoding is None:
+        max_chars = max_tokens * CHARS_PER_TOKEN
+        if len(text) <= max_chars:
+            return text
+        truncated = text[:max_chars]
+    else:
+        tokens = encoding.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        truncated = encoding.decode(tokens[:max_tokens])
+    cut = truncated.rfind("\n")
+    return truncated[:cut] if cut > 0 else truncated
 
+# Template placeholder patterns; XM8_ must come before the generic [...] form to win the alternation
+FIELD_RE = re.compile(r'\[XM8_([A-Z0-9_]+)\]|\[([A-Za-z0-9_]+)\]|\{([A-Z0-9_]+)\}|<<([A-Z0-9_]+)>>')
+
+@st.cache_data(show_spinner=False)
 def extract_template_fields(template_text):
     """Extract placeholder fields from template."""
-    patterns = [
-        r'\[([A-Z0-9_]+)\]',
-        r'\[XM8_([A-Z0-9_]+)\]',
-        r'\{([A-Z0-9_]+)\}',
-        r'<<([A-Z0-9_]+)>>',
-        r'\[([a-zA-Z0-9_]+)\]'
-    ]
     fields = set()
-    for pattern in patterns:
-        matches = re.findall(pattern, template_text)
-        fields.update(matches)
-    return list(fields)
+    for match in FIELD_RE.finditer(template_text):
+        fields.add(match.group(match.lastindex))
+    # Sorted so the LLM prompt, and its cache key, is stable across processes
+    return sorted(fields)
 
-def call_llm(prompt, api_key, model):
-    """Call OpenRouter LLM API."""
-    if not api_key:
-        st.error("Please enter your OpenRouter API key in the sidebar.")
-        return None
+@st.cache_resource
+def get_http_session():
+    """Shared HTTP session so OpenRouter calls reuse pooled connections across reruns."""
+    import requests
     
-    headers = {
-        "Authorization": f"Bearer {api_key}",
+    session = requests.Session()
+    session.headers.update({
         "Content-Type": "application/json",
         "HTTP-Referer": "https://streamlit.app",
         "X-Title": "GLR Pipeline"
-    }
+    })
+    return session
+
+def parse_json_response(response):
+    """Parse a JSON LLM response, salvaging the object from code fences or surrounding prose."""
+    try:
+        return json.loads(response)
+    except json.JSONDecodeError:
+        # Models that ignore response_format may wrap the object in ```json fences or prose
+        json_match = re.search(r'\{[\s\S]*\}', response)
+        if not json_match:
+            raise
+        return json.loads(json_match.group())
+
+class TruncatedResponseError(Exception):
+    """Raised when the LLM stops at max_tokens, leaving an incomplete reply."""
+
+# On-disk LLM response cache, persists across Streamlit sessions
+LLM_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".glr_cache")
+LLM_CACHE_TTL = 3600
+
+@st.cache_data(ttl=LLM_CACHE_TTL, show_spinner=False)
+def request_completion(prompt, model, max_tokens, json_mode, _api_key):
+    """Return the OpenRouter completion for a prompt, cached by (model, prompt).
+    
+    The API key is underscore-prefixed so Streamlit leaves it out of the cache key.
+    Errors, cut-off replies and unparseable JSON replies are raised, not cached.
+    """
+    cache_key = hashlib.sha256(f"{model}\n{max_tokens}\n{json_mode}\n{prompt}".encode("utf-8")).hexdigest()
+    cache_path = os.path.join(LLM_CACHE_DIR, f"{cache_key}.json")
+    try:
+        if time.time() - os.path.getmtime(cache_path) < LLM_CACHE_TTL:
+            with open(cache_path, encoding="utf-8") as f:
+                return json.load(f)["response"]
+    except (OSError, ValueError, KeyError):
+        pass  # Missing or unreadable entries are refetched, and a complete reply overwrites them
+    
+    headers = {"Authorization": f"Bearer {_api_key}"}
     
     data = {
         "model": model,
         "messages": [{"role": "user", "content": prompt}],
-        "max_tokens": 4000,
+        "max_tokens": max_tokens,
         "temperature": 0.3
     }
+    if json_mode:
+        data["response_format"] = {"type": "json_object"}
+    
+    response = get_http_session().post(
+        "https://openrouter.ai/api/v1/chat/completions",
+        headers=headers,
+        json=data,
+        timeout=60
+    )
+    response.raise_for_status()
+    choice = response.json()["choices"][0]
+    content = choice["message"]["content"]
+    # Raised rather than returned so a cut-off reply is never cached
+    if choice.get("finish_reason") == "length":
+        raise TruncatedResponseError(f"LLM response was cut off at {max_tokens} tokens")
+    if json_mode:
+        parse_json_response(content)  # Raises on an unparseable reply so it is not cached
+    
+    # Only complete replies are persisted; write to a temp file and rename so readers never see a partial entry
+    if choice.get("finish_reason") == "stop":
+        try:
+            os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=LLM_CACHE_DIR, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump({"model": model, "response": content}, f)
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                os.remove(tmp_path)
+                raise
+        except OSError:
+            pass  # The disk cache is best-effort
+    
+    return content
+
+def call_llm(prompt, api_key, model, max_tokens=4000, json_mode=False):
+    """Call OpenRouter LLM API."""
+    if not api_key:
+        st.error("Please enter your OpenRouter API key in the sidebar.")
+        return None
     
     try:
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers=headers,
-            json=data,
-            timeout=60
-        )
-        response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
+        try:
+            return request_completion(prompt, model, max_tokens, json_mode, api_key)
+        except TruncatedResponseError:
+            st.warning(f"LLM response hit the {max_tokens}-token limit; retrying with {max_tokens * 2}.")
+            return request_completion(prompt, model, max_tokens * 2, json_mode, api_key)
+    except json.JSONDecodeError:
+        st.warning("Could not parse LLM response as JSON.")
+        return None
     except Exception as e:
         st.error(f"LLM API Error: {e}")
         return None
 
-def extract_key_values_from_reports(photo_reports_text, template_fields, api_key, model):
-    """Use LLM to extract key-value pairs from photo reports."""
+# GLR narrative sections, keyed by the field name a template would use for them.
+# The short code is the JSON key the LLM returns, keeping output tokens down.
+NARRATIVE_SECTIONS = {
+    "DWELLING_DESCRIPTION": ("DW", "Describe the property type, construction, roofing materials"),
+    "PROPERTY_CONDITION": ("PC", "General condition observations"),
+    "ROOF_INSPECTION": ("RI", "Findings for each slope (front, right, rear, left)"),
+    "FRONT_ELEVATION": ("FE", "Damage findings"),
+    "RIGHT_ELEVATION": ("RT", "Damage findings"),
+    "REAR_ELEVATION": ("RR", "Damage findings"),
+    "LEFT_ELEVATION": ("LE", "Damage findings"),
+    "INTERIOR": ("IN", "Any interior damage noted"),
+    "OTHER_STRUCTURES": ("OS", "Detached garage, shed, fence, pool findings"),
+    "CAUSE_AND_ORIGIN": ("CO", "Type of loss and cause")
+}
+
+# Output token caps for the extraction call
+FIELDS_MAX_TOKENS = 1500
+NARRATIVE_SECTION_MAX_TOKENS = 80
+
+def extract_all(photo_reports_text, template_fields, api_key, model):
+    """Use one LLM call to extract key-value pairs and generate report narratives."""
+    
+    report_text = truncate_to_tokens(photo_reports_text, PHOTO_TEXT_TOKEN_BUDGET)
     
-    prompt = f"""You are an insurance claims data extraction assistant. 
+    # Sections the template already has a field for come back in "fields"; don't generate them twice
+    requested_fields = set(template_fields)
+    missing_sections = [key for key in NARRATIVE_SECTIONS if key not in requested_fields]
+    
+    narrative_task = ""
+    narrative_output = ""
+    if missing_sections:
+        section_lines = "\n".join(
+            f"{NARRATIVE_SECTIONS[key][0]}: {key.replace('_', ' ')} - {NARRATIVE_SECTIONS[key][1]}"
+            for key in missing_sections
+        )
+        narrative_task = f"""TASK 2 - REPORT NARRATIVES
+
+Write the following narrative sections for a General Loss Report (GLR).
+Each section 40 words or fewer; use telegraphic insurance report style.
+
+{section_lines}
+
+"""
+        narrative_output = '- "narratives": an object with the section codes above (e.g. "DW") as keys and narrative text as values\n'
+    
+    prompt = f"""You are an insurance claims data extraction assistant and report writer.
     
 I have the following photo report text from an insurance inspection:
 
 --- PHOTO REPORT TEXT ---
-{photo_reports_text[:15000]}
+{report_text}
 --- END PHOTO REPORT ---
 
+TASK 1 - FIELD EXTRACTION
+
 I need to extract values for these template fields:
 {json.dumps(template_fields, indent=2)}
 
 Please analyze the photo report and extract relevant information for each field.
-Return ONLY a valid JSON object with field names as keys and extracted values as values.
-
 For fields you cannot find data for, use reasonable defaults or leave as empty string.
+Keep values short: no explanations or restated field names.
 
 Common field mappings:
 - INSURED_NAME: The policyholder/insured name
@@ -124,78 +319,111 @@ Also extract and summarize:
 - Other structures damage
 - Fence/pool/other damage
 
-Return ONLY the JSON object, no additional text.
-"""
+{narrative_task}OUTPUT FORMAT
+
+Return ONLY a valid JSON object with these top-level keys:
+- "fields": an object with template field names as keys and extracted values as values
+{narrative_output}"""
     
-    response = call_llm(prompt, api_key, model)
+    max_tokens = FIELDS_MAX_TOKENS + NARRATIVE_SECTION_MAX_TOKENS * len(missing_sections)
+    response = call_llm(prompt, api_key, model, max_tokens=max_tokens, json_mode=True)
     
-    if response:
-        try:
-            json_match = re.search(r'\{[\s\S]*\}', response)
-            if json_match:
-                return json.loads(json_match.group())
-        except json.JSONDecodeError:
-            st.warning("Could not parse LLM response as JSON. Using raw response.")
-    
-    return {}
-
-def generate_report_narrative(photo_reports_text, api_key, model):
-    """Generate narrative sections for the GLR report."""
-    
-    prompt = f"""You are an insurance claims report writer. Based on the following photo report inspection data, 
-generate professional narrative sections for a General Loss Report (GLR).
-
---- PHOTO REPORT DATA ---
-{photo_reports_text[:12000]}
---- END DATA ---
-
-Generate the following sections in a professional insurance report style:
-
-1. DWELLING DESCRIPTION: Describe the property type, construction, roofing materials
-2. PROPERTY CONDITION: General condition observations
-3. ROOF INSPECTION: Detailed findings for each slope (front, right, rear, left)
-4. FRONT ELEVATION: Damage findings
-5. RIGHT ELEVATION: Damage findings
-6. REAR ELEVATION: Damage findings
-7. LEFT ELEVATION: Damage findings
-8. INTERIOR: Any interior damage noted
-9. OTHER STRUCTURES: Detached garage, shed, fence, pool findings
-10. CAUSE AND ORIGIN: Type of loss and cause
-
-Format your response as JSON with section names as keys and narrative text as values.
-Return ONLY the JSON object.
-"""
+    if not response:
+        return {}, {}
     
-    response = call_llm(prompt, api_key, model)
+    try:
+        data = parse_json_response(response)
+    except json.JSONDecodeError:
+        st.warning("Could not parse LLM response as JSON.")
+        return {}, {}
     
-    if response:
-        try:
-            json_match = re.search(r'\{[\s\S]*\}', response)
-            if json_match:
-                return json.loads(json_match.group())
-        except:
-            pass
+    if not isinstance(data, dict):
+        st.warning("LLM response was not a JSON object.")
+        return {}, {}
+    
+    fields = data.get("fields")
+    if not isinstance(fields, dict):
+        fields = {}
+    
+    raw_narratives = data.get("narratives")
+    if not isinstance(raw_narratives, dict):
+        raw_narratives = {}
     
-    return {}
+    # Decode section codes back to readable section names
+    section_names = {code: key.replace("_", " ") for key, (code, _) in NARRATIVE_SECTIONS.items()}
+    narratives = {section_names.get(code, code): text for code, text in raw_narratives.items()}
+    return fields, narratives
+
+def may_contain_placeholder(text):
+    """Cheap pre-check before a placeholder regex: every placeholder form contains [, { or <."""
+    return "[" in text or "{" in text or "<" in text
 
 def fill_template(template_doc, extracted_data, narratives):
     """Fill the template document with extracted data."""
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import qn
+    from lxml import etree
+    
+    mapping = {}
+    for key, value in extracted_data.items():
+        for placeholder in (f"[{key}]", f"[XM8_{key}]", f"{{{key}}}", f"<<{key}>>"):
+            mapping[placeholder] = str(value) if value else ""
+    
+    if not mapping:
+        return template_doc
+    
+    placeholder_re = re.compile("|".join(re.escape(p) for p in mapping))
+    
+    # Fast path: one regex pass over the serialized body replaces every placeholder held within a single run.
+    # Text is XML-escaped there (<<K>> appears as &lt;&lt;K&gt;&gt;), so match and insert escaped forms.
+    # Placeholders also occur in attribute values (content-control w:value), so quotes are escaped too.
+    # Values with newlines, tabs or edge whitespace are left to the run setter, which emits
+    # <w:br/>, <w:tab/> and xml:space="preserve" instead of raw characters Word renders as spaces.
+    body = template_doc.element.body
+    xml_mapping = {
+        escape(p): escape(v, {'"': "&quot;"}) for p, v in mapping.items()
+        if v == v.strip() and "\n" not in v and "\r" not in v and "\t" not in v
+    }
+    if xml_mapping:
+        xml_placeholder_re = re.compile("|".join(re.escape(p) for p in xml_mapping))
+        body_xml, count = xml_placeholder_re.subn(
+            lambda m: xml_mapping[m.group(0)], etree.tostring(body, encoding="unicode")
+        )
+        if count:
+            # Swap children rather than the body element so python-docx's cached wrappers stay valid
+            body[:] = list(parse_xml(body_xml))
+    
+    # Only placeholders split across runs are left; if there are none, skip the paragraph walk
+    if not placeholder_re.search("".join(body.itertext(qn("w:t")))):
+        return template_doc
+    
+    def replace(match):
+        return mapping[match.group(0)]
+    
+    def fill_paragraph(para):
+        if not may_contain_placeholder(para.text):
+            return
+        # Replace inside runs so bold, fonts and colors are kept
+        for run in para.runs:
+            run_text = run.text
+            if not may_contain_placeholder(run_text):
+                continue
+            new_text = placeholder_re.sub(replace, run_text)
+            if new_text != run_text:
+                run.text = new_text
+        # A placeholder split across runs can only be replaced at paragraph level, which drops run formatting
+        text = para.text
+        if placeholder_re.search(text):
+            para.text = placeholder_re.sub(replace, text)
     
     for para in template_doc.paragraphs:
-        for key, value in extracted_data.items():
-            placeholders = [f"[{key}]", f"[XM8_{key}]", f"{{{key}}}", f"<<{key}>>"]
-            for placeholder in placeholders:
-                if placeholder in para.text:
-                    para.text = para.text.replace(placeholder, str(value) if value else "")
+        fill_paragraph(para)
     
     for table in template_doc.tables:
         for row in table.rows:
             for cell in row.cells:
-                for key, value in extracted_data.items():
-                    placeholders = [f"[{key}]", f"[XM8_{key}]", f"{{{key}}}", f"<<{key}>>"]
-                    for placeholder in placeholders:
-                        if placeholder in cell.text:
-                            cell.text = cell.text.replace(placeholder, str(value) if value else "")
+                for para in cell.paragraphs:
+                    fill_paragraph(para)
     
     return template_doc
 
@@ -236,23 +464,27 @@ if st.button("🚀 Process and Generate Report", type="primary",
     with st.spinner("Processing..."):
         # Step 1: Extract text from photo reports
         st.info("📖 Step 1: Extracting text from photo reports...")
-        combined_photo_text = ""
-        
+        photo_text_parts = []
         for pdf_file in photo_files:
-            pdf_file.seek(0)
-            text = extract_text_from_pdf(pdf_file)
-            combined_photo_text += f"\n--- {pdf_file.name} ---\n{text}\n"
+            # getvalue() returns the upload's existing buffer without seeking or re-reading it
+            try:
+                text = extract_text_from_pdf(pdf_file.getvalue())
+            except Exception as e:
+                st.error(f"Error extracting PDF {pdf_file.name}: {e}")
+                text = ""
+            photo_text_parts.append(f"\n--- {pdf_file.name} ---\n{text}\n")
+        combined_photo_text = "".join(photo_text_parts)
         
         st.success(f"Extracted {len(combined_photo_text)} characters from photo reports")
         
         # Step 2: Load template and extract fields
         st.info("📋 Step 2: Analyzing template fields...")
+        from docx import Document
+        
         template_file.seek(0)
         template_doc = Document(template_file)
         
-        template_text = ""
-        for para in template_doc.paragraphs:
-            template_text += para.text + "\n"
+        template_text = "\n".join(para.text for para in template_doc.paragraphs)
         
         template_fields = extract_template_fields(template_text)
         st.success(f"Found {len(template_fields)} template fields")
@@ -260,9 +492,9 @@ if st.button("🚀 Process and Generate Report", type="primary",
         with st.expander("View detected template fields"):
             st.write(template_fields)
         
-        # Step 3: Extract key-value pairs using LLM
-        st.info("🤖 Step 3: Extracting data using LLM...")
-        extracted_data = extract_key_values_from_reports(
+        # Step 3: Extract key-value pairs and generate narratives in one LLM call
+        st.info("🤖 Step 3: Extracting data and generating narratives using LLM...")
+        extracted_data, narratives = extract_all(
             combined_photo_text, template_fields, OPENROUTER_API_KEY, MODEL
         )
         
@@ -271,27 +503,20 @@ if st.button("🚀 Process and Generate Report", type="primary",
             with st.expander("View extracted data"):
                 st.json(extracted_data)
         
-        # Step 4: Generate narratives
-        st.info("✍️ Step 4: Generating report narratives...")
-        narratives = generate_report_narrative(
-            combined_photo_text, OPENROUTER_API_KEY, MODEL
-        )
-        
         if narratives:
             st.success("Generated report narratives")
             with st.expander("View generated narratives"):
                 st.json(narratives)
         
-        # Step 5: Fill template
-        st.info("📝 Step 5: Filling template...")
-        template_file.seek(0)
-        output_doc = Document(template_file)
+        # Step 4: Fill template
+        st.info("📝 Step 4: Filling template...")
         
         # Add current date
         extracted_data['DATE_CURRENT'] = datetime.now().strftime("%m/%d/%Y")
         extracted_data['XM8_DATE_CURRENT'] = datetime.now().strftime("%m/%d/%Y")
         
-        filled_doc = fill_template(output_doc, extracted_data, narratives)
+        # The Step 2 document is only read for field names, so fill it in place rather than re-parsing the upload
+        filled_doc = fill_template(template_doc, extracted_data, narratives)
         
         # Save to buffer
         doc_buffer = io.BytesIO()
@@ -304,10 +529,8 @@ if st.button("🚀 Process and Generate Report", type="primary",
         st.markdown("---")
         st.subheader("📄 Generated Report Preview")
         
-        preview_text = ""
-        for para in filled_doc.paragraphs[:30]:
-            if para.text.strip():
-                preview_text += para.text + "\n\n"
+        preview_paragraphs = (para.text for para in filled_doc.paragraphs[:30])
+        preview_text = "".join(text + "\n\n" for text in preview_paragraphs if text.strip())
         
         st.text_area("Report Preview (first 30 paragraphs)", preview_text, height=400)
         